@@ -5,6 +5,8 @@
 import os
 import time
 import json
+import socket
+import zlib
 import logging
 import requests
 import psycopg2
@@ -29,11 +31,36 @@ if not (DB_NAME and DB_USER and (DB_HOST or DB_URL) and DB_PASSWORD):
     logger.error("Faltam variáveis de ambiente de BD. Defina DB_HOST/DB_URL, DB_NAME, DB_USER, DB_PASSWORD.")
     raise SystemExit(1)
 
+# --- Coordenação entre réplicas (COORDINATION_MODE=advisory habilita)
+COORDINATION_MODE = os.getenv("COORDINATION_MODE", "").strip().lower()
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}"
+TICK_SECONDS = int(os.getenv("TICK_SECONDS", "60"))
+LOCK_RETRY_SECONDS = float(os.getenv("LOCK_RETRY_SECONDS", "1.0"))
+# Detecção de réplica morta: keepalive TCP (cliente e servidor) e limite para transação ociosa segurando lock
+DB_KEEPALIVES_IDLE = int(os.getenv("DB_KEEPALIVES_IDLE", "10"))
+DB_KEEPALIVES_INTERVAL = int(os.getenv("DB_KEEPALIVES_INTERVAL", "5"))
+DB_KEEPALIVES_COUNT = int(os.getenv("DB_KEEPALIVES_COUNT", "3"))
+IDLE_IN_TRANSACTION_TIMEOUT_SECONDS = int(os.getenv("IDLE_IN_TRANSACTION_TIMEOUT_SECONDS", str(max(1, TICK_SECONDS // 2))))
+# Instrumentos coletados no modo coordenado: cada um é um shard, então mais réplicas cobrem mais instrumentos
+INSTRUMENTS = [name.strip() for name in os.getenv("INSTRUMENTS", "BTC-PERPETUAL,ETH-PERPETUAL,SOL-PERPETUAL").split(",") if name.strip()]
+
+if TICK_SECONDS <= 0:
+    logger.error("TICK_SECONDS deve ser maior que zero (recebido %d).", TICK_SECONDS)
+    raise SystemExit(1)
+
+if COORDINATION_MODE == "advisory" and not 0 < IDLE_IN_TRANSACTION_TIMEOUT_SECONDS < TICK_SECONDS:
+    logger.error("IDLE_IN_TRANSACTION_TIMEOUT_SECONDS deve ficar entre 0 e TICK_SECONDS (recebido %d, TICK_SECONDS=%d).", IDLE_IN_TRANSACTION_TIMEOUT_SECONDS, TICK_SECONDS)
+    raise SystemExit(1)
+
+if not INSTRUMENTS:
+    logger.error("INSTRUMENTS não pode ser vazio.")
+    raise SystemExit(1)
+
 # --- Deribit API base
 DERIBIT_BASE = "https://www.deribit.com/api/v2"
 
 # --- Tabela alvo
-TABLE_NAME = "tb_deribit_info_ini"
+TABLE_NAME = os.getenv("TABLE_NAME", "tb_deribit_info_ini")
 
 # --- Criação da tabela (adicionados campos de candle upper/lower wicks)
 CREATE_TABLE_SQL = f"""
@@ -94,6 +121,60 @@ INSERT INTO {TABLE_NAME} (
 );
 """
 
+# --- Instrumentos da tabela larga (modo padrão): prefixo da coluna -> instrumento
+WIDE_INSTRUMENTS = {
+    "btc": "BTC-PERPETUAL",
+    "eth": "ETH-PERPETUAL",
+    "sol": "SOL-PERPETUAL",
+}
+
+# Moedas com índice DVOL na Deribit
+DVOL_CURRENCIES = ("BTC", "ETH")
+
+# --- Tabela estreita do modo coordenado: uma linha por (tick_slot, instrumento)
+# A própria linha é o lease: se existe, o instrumento já foi gravado naquele tick
+INSTRUMENT_TABLE_NAME = f"{TABLE_NAME}_instrument"
+
+CREATE_INSTRUMENT_TABLE_SQL = f"""
+CREATE TABLE IF NOT EXISTS {INSTRUMENT_TABLE_NAME} (
+    tick_slot TIMESTAMP WITH TIME ZONE NOT NULL,
+    instrument TEXT NOT NULL,
+    timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+    mark NUMERIC,
+    index_price NUMERIC,
+    funding NUMERIC,
+    open_interest NUMERIC,
+    v24h NUMERIC,
+    dvol NUMERIC,
+    upper_wick NUMERIC,
+    lower_wick NUMERIC,
+    replica_id TEXT NOT NULL,
+    PRIMARY KEY (tick_slot, instrument)
+);
+"""
+
+INSERT_INSTRUMENT_SQL = f"""
+INSERT INTO {INSTRUMENT_TABLE_NAME} (
+    tick_slot, instrument, timestamp,
+    mark, index_price, funding, open_interest, v24h, dvol,
+    upper_wick, lower_wick, replica_id
+) VALUES (
+    %(tick_slot)s, %(instrument)s, %(timestamp)s,
+    %(mark)s, %(index)s, %(funding)s, %(open_interest)s, %(v24h)s, %(dvol)s,
+    %(upper_wick)s, %(lower_wick)s, %(replica_id)s
+);
+"""
+
+INSTRUMENT_ROW_EXISTS_SQL = f"SELECT replica_id FROM {INSTRUMENT_TABLE_NAME} WHERE tick_slot = %s AND instrument = %s"
+
+# Só leitura de catálogo: não roda DDL quando a tabela já existe
+COORDINATION_SCHEMA_CHECK_SQL = f"SELECT to_regclass('{INSTRUMENT_TABLE_NAME}') IS NOT NULL"
+
+SCHEMA_LOCK_TIMEOUT = "5s"
+
+# Lock transacional: liberado no commit/rollback ou quando a conexão da réplica cai
+TRY_INSTRUMENT_LOCK_SQL = "SELECT pg_try_advisory_xact_lock(hashtext(%s), hashtext(%s))"
+
 
 
 def get_volatility_index(currency: str) -> float:
@@ -127,23 +208,61 @@ def get_volatility_index(currency: str) -> float:
 
 
 # --- DB helpers
-def get_db_connection():
+def get_db_connection(**kwargs):
     if DB_URL:
-        return psycopg2.connect(DB_URL)
+        return psycopg2.connect(DB_URL, **kwargs)
     return psycopg2.connect(
         dbname=DB_NAME,
         user=DB_USER,
         password=DB_PASSWORD,
         host=DB_HOST,
-        port=DB_PORT
+        port=DB_PORT,
+        **kwargs
     )
 
+def get_coordination_connection():
+    # Keepalive no cliente (libpq) e no servidor: sem isso o backend de uma réplica em outra máquina que caiu
+    # segura o advisory lock até o keepalive padrão do SO (~2h)
+    conn = get_db_connection(
+        keepalives=1,
+        keepalives_idle=DB_KEEPALIVES_IDLE,
+        keepalives_interval=DB_KEEPALIVES_INTERVAL,
+        keepalives_count=DB_KEEPALIVES_COUNT,
+    )
+    with conn.cursor() as cur:
+        cur.execute("SET tcp_keepalives_idle = %s", (DB_KEEPALIVES_IDLE,))
+        cur.execute("SET tcp_keepalives_interval = %s", (DB_KEEPALIVES_INTERVAL,))
+        cur.execute("SET tcp_keepalives_count = %s", (DB_KEEPALIVES_COUNT,))
+        # O lock fica ocioso na transação durante as chamadas HTTP; réplica travada perde a sessão e libera o lock
+        cur.execute("SET idle_in_transaction_session_timeout = %s", (f"{IDLE_IN_TRANSACTION_TIMEOUT_SECONDS}s",))
+    conn.commit()
+    return conn
+
 def ensure_table_exists(conn):
     with conn.cursor() as cur:
         cur.execute(CREATE_TABLE_SQL)
     conn.commit()
     logger.debug("Tabela verificada/criada.")
 
+def ensure_coordination_schema(conn):
+    with conn.cursor() as cur:
+        cur.execute(COORDINATION_SCHEMA_CHECK_SQL)
+        if cur.fetchone()[0]:
+            conn.commit()
+            return
+        # Serializa o DDL entre réplicas que sobem ao mesmo tempo (antes do lock_timeout, que valeria para esta espera)
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (TABLE_NAME,))
+        # Quem perdeu a corrida encontra o schema pronto e não roda DDL
+        cur.execute(COORDINATION_SCHEMA_CHECK_SQL)
+        if cur.fetchone()[0]:
+            conn.commit()
+            return
+        # lock_timeout evita enfileirar a tabela atrás de leitores longos
+        cur.execute(f"SET LOCAL lock_timeout = '{SCHEMA_LOCK_TIMEOUT}'")
+        cur.execute(CREATE_INSTRUMENT_TABLE_SQL)
+    conn.commit()
+    logger.debug("Schema de coordenação verificado/criado.")
+
 # --- Deribit request with retries
 def deribit_get(path: str, params: Optional[Dict[str, Any]] = None, retries: int = 3, backoff: float = 1.0) -> Any:
     url = f"{DERIBIT_BASE}{path}"
@@ -233,57 +352,37 @@ def get_latest_candle_wicks(instrument_name: str, resolution: str = CANDLE_RESOL
     return {"upper_wick": 0.0, "lower_wick": 0.0}
 
 
+# --- Coleta de um instrumento (mark, index, funding, open_interest, v24h, dvol, wicks)
+def collect_instrument(instrument: str) -> Dict[str, Optional[float]]:
+    data = get_instrument_summary(instrument)
+    # candles wicks (resolution 1 minute)
+    data.update(get_latest_candle_wicks(instrument, resolution="1"))
+
+    currency = instrument.split("-")[0].upper()
+    if currency in DVOL_CURRENCIES:
+        data["dvol"] = get_volatility_index(currency)
+        logger.info("DVOL %s retornado: %s", currency, data["dvol"])
+    return data
+
+
 # --- Main collect and store
 def collect_and_store():
-    from datetime import datetime, timezone
     timestamp = datetime.now(timezone.utc)
 
-    # instrument names
-    BTC_INSTR = "BTC-PERPETUAL"
-    ETH_INSTR = "ETH-PERPETUAL"
-    SOL_INSTR = "SOL-PERPETUAL"
-
-    # summaries
-    btc_summary = get_instrument_summary(BTC_INSTR)
-    eth_summary = get_instrument_summary(ETH_INSTR)
-    sol_summary = get_instrument_summary(SOL_INSTR)
-
-    # candles wicks (resolution 1 minute)
-    btc_wicks = get_latest_candle_wicks(BTC_INSTR, resolution="1")
-    eth_wicks = get_latest_candle_wicks(ETH_INSTR, resolution="1")
-    sol_wicks = get_latest_candle_wicks(SOL_INSTR, resolution="1")
-
-    dvol_btc = get_volatility_index("BTC")
-    dvol_eth = get_volatility_index("ETH")
-    logger.info("DVOL BTC retornado: %s", dvol_btc)
-    logger.info("DVOL ETH retornado: %s", dvol_eth)
-
-    payload = {
-        "timestamp": timestamp,
-        "btc_mark": btc_summary.get("mark"),
-        "btc_index": btc_summary.get("index"),
-        "eth_mark": eth_summary.get("mark"),
-        "eth_index": eth_summary.get("index"),
-        "sol_mark": sol_summary.get("mark"),
-        "sol_index": sol_summary.get("index"),
-        "funding_btc": btc_summary.get("funding"),
-        "funding_eth": eth_summary.get("funding"),
-        "funding_sol": sol_summary.get("funding"),
-        "open_interest_btc": btc_summary.get("open_interest"),
-        "open_interest_eth": eth_summary.get("open_interest"),
-        "open_interest_sol": sol_summary.get("open_interest"),
-        "v24h_btc": btc_summary.get("v24h"),
-        "v24h_eth": eth_summary.get("v24h"),
-        "v24h_sol": sol_summary.get("v24h"),
-        "dvol_btc": dvol_btc,
-        "dvol_eth": dvol_eth,
-        "upper_wick_btc": btc_wicks.get("upper_wick"),
-        "lower_wick_btc": btc_wicks.get("lower_wick"),
-        "upper_wick_eth": eth_wicks.get("upper_wick"),
-        "lower_wick_eth": eth_wicks.get("lower_wick"),
-        "upper_wick_sol": sol_wicks.get("upper_wick"),
-        "lower_wick_sol": sol_wicks.get("lower_wick")
-}
+    payload: Dict[str, Any] = {"timestamp": timestamp}
+    for prefix, instrument in WIDE_INSTRUMENTS.items():
+        data = collect_instrument(instrument)
+        payload.update({
+            f"{prefix}_mark": data.get("mark"),
+            f"{prefix}_index": data.get("index"),
+            f"funding_{prefix}": data.get("funding"),
+            f"open_interest_{prefix}": data.get("open_interest"),
+            f"v24h_{prefix}": data.get("v24h"),
+            f"upper_wick_{prefix}": data.get("upper_wick"),
+            f"lower_wick_{prefix}": data.get("lower_wick"),
+        })
+        if prefix.upper() in DVOL_CURRENCIES:
+            payload[f"dvol_{prefix}"] = data.get("dvol")
     logger.info("Payload coletado: %s", json.dumps({k: v for k, v in payload.items() if k != "timestamp"}, default=str))
 
     conn = None
@@ -303,9 +402,96 @@ def collect_and_store():
         if conn:
             conn.close()
 
+
+# --- Coleta coordenada entre réplicas
+# Relógio do banco: todas as réplicas usam a mesma fonte de tempo, mesmo com hosts dessincronizados
+def db_now(conn) -> datetime:
+    with conn.cursor() as cur:
+        cur.execute("SELECT clock_timestamp()")
+        now = cur.fetchone()[0]
+    conn.commit()
+    return now
+
+def current_tick_slot(now: datetime) -> datetime:
+    epoch = int(now.timestamp())
+    return datetime.fromtimestamp(epoch - epoch % TICK_SECONDS, tz=timezone.utc)
+
+# Retorna "stored" se gravou, "done" se outra réplica já gravou, "busy" se o lock está ocupado
+def try_collect_instrument(conn, tick_slot: datetime, instrument: str) -> str:
+    try:
+        with conn.cursor() as cur:
+            cur.execute(TRY_INSTRUMENT_LOCK_SQL, (INSTRUMENT_TABLE_NAME, f"{tick_slot.isoformat()}:{instrument}"))
+            if not cur.fetchone()[0]:
+                conn.rollback()
+                return "busy"
+            cur.execute(INSTRUMENT_ROW_EXISTS_SQL, (tick_slot, instrument))
+            if cur.fetchone():
+                conn.rollback()
+                return "done"
+
+            data = collect_instrument(instrument)
+            logger.info("Payload coletado (%s): %s", instrument, json.dumps(data, default=str))
+            payload: Dict[str, Any] = dict(data, tick_slot=tick_slot, instrument=instrument, timestamp=datetime.now(timezone.utc), replica_id=REPLICA_ID)
+            cur.execute(INSERT_INSTRUMENT_SQL, payload)
+        conn.commit()
+        logger.info("Instrumento %s gravado por %s no tick %s", instrument, REPLICA_ID, tick_slot.isoformat())
+        return "stored"
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+
+def collect_and_store_coordinated(tick_slot: Optional[datetime] = None):
+    # Cada réplica começa num instrumento diferente para reduzir disputa pelos locks
+    offset = zlib.crc32(REPLICA_ID.encode()) % len(INSTRUMENTS)
+    pending = INSTRUMENTS[offset:] + INSTRUMENTS[:offset]
+
+    failed = []
+    conn = None
+    try:
+        conn = get_coordination_connection()
+        ensure_coordination_schema(conn)
+        # tick_slot explícito fixa o tick (usado pelo testa_replicas.py); senão vem do relógio do banco
+        tick_slot = tick_slot or current_tick_slot(db_now(conn))
+        deadline = tick_slot + timedelta(seconds=TICK_SECONDS)
+        while pending:
+            busy = []
+            for instrument in pending:
+                # Sessão encerrada pelo servidor (ex.: idle_in_transaction_session_timeout): reconecta
+                if conn.closed:
+                    conn = get_coordination_connection()
+                # Falha num instrumento não impede os demais; outra réplica pode reassumir o que falhou
+                try:
+                    if try_collect_instrument(conn, tick_slot, instrument) == "busy":
+                        busy.append(instrument)
+                except Exception:
+                    logger.exception("Erro ao coletar/gravar instrumento %s no tick %s", instrument, tick_slot.isoformat())
+                    failed.append(instrument)
+            pending = busy
+            if not pending:
+                break
+            # Instrumentos ocupados são reavaliados: se a réplica dona cair, o lock é liberado e assumimos
+            if conn.closed:
+                conn = get_coordination_connection()
+            if db_now(conn) >= deadline:
+                logger.warning("Tick %s encerrado com instrumentos ainda ocupados: %s", tick_slot.isoformat(), pending)
+                break
+            time.sleep(LOCK_RETRY_SECONDS)
+        if failed:
+            raise RuntimeError(f"Falha ao gravar instrumentos no tick {tick_slot.isoformat()}: {', '.join(failed)}")
+    except Exception as e:
+        logger.exception("Erro ao persistir dados: %s", e)
+        raise
+    finally:
+        if conn:
+            conn.close()
+
 def main():
     try:
-        collect_and_store()
+        if COORDINATION_MODE == "advisory":
+            collect_and_store_coordinated()
+        else:
+            collect_and_store()
     except Exception as e:
         logger.error("Execução finalizada com erro: %s", e)
         raise
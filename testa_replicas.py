@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# testa_replicas.py
+# Harness local do modo COORDINATION_MODE=advisory: sobe várias réplicas contra um PostgreSQL local,
+# mata uma enquanto ela segura um instrumento e confere as linhas no banco. Não acessa a Deribit.
+# Executar: DB_URL=... DB_NAME=... DB_USER=... DB_PASSWORD=... python testa_replicas.py
+# Usa tabela própria (HARNESS_TABLE_instrument), recriada a cada execução.
+
+import os
+import sys
+import time
+import signal
+import logging
+import tempfile
+import subprocess
+from datetime import datetime
+
+HARNESS_TABLE = os.getenv("HARNESS_TABLE", "tb_deribit_info_ini_harness")
+HARNESS_REPLICAS = int(os.getenv("HARNESS_REPLICAS", "3"))
+HARNESS_TIMEOUT = float(os.getenv("HARNESS_TIMEOUT", "60"))
+# Mais instrumentos que réplicas sadias, para exercitar a divisão do trabalho
+HARNESS_INSTRUMENTS = [f"TST{i}-PERPETUAL" for i in range(int(os.getenv("HARNESS_INSTRUMENTS", "6")))]
+
+# Réplicas filhas herdam estas variáveis; sobrescreve valores de produção que estejam no ambiente.
+# O tick_slot é fixado pelo harness, e o tick longo só garante que o deadline não chega durante o teste.
+os.environ["TABLE_NAME"] = HARNESS_TABLE
+os.environ["COORDINATION_MODE"] = "advisory"
+os.environ["INSTRUMENTS"] = ",".join(HARNESS_INSTRUMENTS)
+os.environ["TICK_SECONDS"] = "3600"
+os.environ["IDLE_IN_TRANSACTION_TIMEOUT_SECONDS"] = "1800"
+os.environ["LOCK_RETRY_SECONDS"] = "0.2"
+
+logger = logging.getLogger("testa_replicas")
+
+
+# --- Réplica com coleta falsa (sem rede)
+def run_worker():
+    import Alimenta_PostGre_Deribit as collector
+
+    hang_marker = os.getenv("HARNESS_HANG_MARKER")
+
+    def fake_collect_instrument(instrument):
+        if hang_marker:
+            # Avisa o harness que o lock do instrumento está tomado e trava até ser morta
+            open(hang_marker, "w").close()
+            time.sleep(3600)
+        fields = ("mark", "index", "funding", "open_interest", "v24h", "dvol", "upper_wick", "lower_wick")
+        return {field: 1.0 for field in fields}
+
+    collector.collect_instrument = fake_collect_instrument
+    collector.collect_and_store_coordinated(tick_slot=datetime.fromisoformat(os.environ["HARNESS_TICK_SLOT"]))
+
+
+def start_worker(replica_id, tick_slot, hang_marker=None):
+    env = dict(os.environ, REPLICA_ID=replica_id, HARNESS_TICK_SLOT=tick_slot.isoformat())
+    env.pop("HARNESS_HANG_MARKER", None)
+    if hang_marker:
+        env["HARNESS_HANG_MARKER"] = hang_marker
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker"], env=env)
+
+
+# --- Cenário: vítima segura um instrumento, réplicas sadias esperam, vítima é morta, sadias assumem
+def run_harness() -> bool:
+    import Alimenta_PostGre_Deribit as collector
+
+    conn = collector.get_db_connection()
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {collector.INSTRUMENT_TABLE_NAME}")
+    # Todas as réplicas usam o mesmo tick_slot, independente de onde o relógio está dentro do tick
+    tick_slot = collector.db_now(conn).replace(microsecond=0)
+
+    marker = os.path.join(tempfile.mkdtemp(), "victim_holds_lock")
+    victim = start_worker("harness-victim", tick_slot, hang_marker=marker)
+    started = time.monotonic()
+    while not os.path.exists(marker):
+        if victim.poll() is not None or time.monotonic() - started > HARNESS_TIMEOUT:
+            logger.error("Réplica vítima não chegou a segurar um instrumento (exit=%s).", victim.poll())
+            victim.kill()
+            return False
+        time.sleep(0.1)
+
+    workers = [start_worker(f"harness-{i}", tick_slot) for i in range(HARNESS_REPLICAS)]
+    # Tempo para as sadias gravarem os instrumentos livres e ficarem esperando o da vítima
+    time.sleep(2)
+    ok = True
+    if any(w.poll() is not None for w in workers):
+        logger.error("Réplicas sadias terminaram antes do failover; o instrumento da vítima não estava bloqueado.")
+        ok = False
+
+    victim.send_signal(signal.SIGKILL)
+    victim.wait()
+
+    for w in workers:
+        try:
+            code = w.wait(timeout=HARNESS_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            w.kill()
+            code = None
+        if code != 0:
+            logger.error("Réplica sadia terminou com exit=%s.", code)
+            ok = False
+
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT instrument, replica_id, tick_slot, mark FROM {collector.INSTRUMENT_TABLE_NAME}")
+        rows = cur.fetchall()
+    conn.close()
+
+    instruments = sorted(instrument for instrument, _, _, _ in rows)
+    slots = {tick_slot for _, _, tick_slot, _ in rows}
+    writers = {replica for _, replica, _, _ in rows}
+    checks = [
+        (instruments == sorted(HARNESS_INSTRUMENTS), f"esperava uma linha por instrumento, encontrou {instruments}"),
+        (slots == {tick_slot}, f"esperava só o tick_slot {tick_slot.isoformat()}, encontrou {sorted(slots)}"),
+        (all(mark is not None for _, _, _, mark in rows), "linha(s) com mark nulo"),
+        ("harness-victim" not in writers, f"linha gravada pela vítima: {writers}"),
+    ]
+    for passed, message in checks:
+        if not passed:
+            logger.error(message)
+            ok = False
+    if ok:
+        logger.info("OK: %d réplicas, %d instrumentos gravados por %s, failover após kill da vítima.", HARNESS_REPLICAS, len(rows), sorted(writers))
+    return ok
+
+
+if __name__ == "__main__":
+    if "--worker" in sys.argv:
+        run_worker()
+    else:
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+        sys.exit(0 if run_harness() else 1)